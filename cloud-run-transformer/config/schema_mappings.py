@@ -3,17 +3,20 @@ Schema mappings module that bridges the old schema.py and mappings.py files
 with the new architecture expected by main.py
 """
 
+import logging
 import sys
 import os
 
 # Add the parent directory to the path to import the existing files
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+logger = logging.getLogger(__name__)
+
 try:
     from schema import SCHEMAS
     from mappings import MAPPINGS
 except ImportError as e:
-    print(f"Warning: Could not import existing schema/mappings files: {e}")
+    logger.warning("Could not import existing schema/mappings files: %s", e)
     SCHEMAS = {}
     MAPPINGS = {}
 
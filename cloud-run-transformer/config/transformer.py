@@ -1,10 +1,12 @@
 """
 Transformation module that applies field mappings and transformations
 to convert raw MongoDB documents into the target schema format.
-UPDATED: Added resilient validation and better handling of callable mappings.
+UPDATED: Better handling of callable mappings; schema validation lives in main.py.
 """
 
-import pandas as pd
+import functools
+import inspect
+import logging
 import sys
 import os
 from datetime import datetime
@@ -12,11 +14,13 @@ from datetime import datetime
 # Add the parent directory to the path to import existing files
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+logger = logging.getLogger(__name__)
+
 try:
     from mappings import Literal
     from config.schema_mappings import get_collection_mapping
 except ImportError as e:
-    print(f"Warning: Could not import mappings: {e}")
+    logger.warning("Could not import mappings: %s", e)
     
     # Fallback Literal class if import fails
     class Literal:
@@ -48,263 +52,157 @@ def get_nested_value(obj, path):
     
     return current
 
-def apply_transformations(source_df, collection_name):
+def compile_path_getter(path):
     """
-    Apply field mappings and transformations to convert source DataFrame
-    to target schema format.
+    Build a getter for a dot-notation path. The path is split once here
+    instead of on every lookup.
     
     Args:
-        source_df (pd.DataFrame): Source DataFrame with normalized JSON data
-        collection_name (str): Name of the collection being processed
+        path (str): Dot-separated path (e.g., 'subscription.status')
         
     Returns:
-        pd.DataFrame: Transformed DataFrame matching target schema
+        callable: Function taking a document and returning the value or None
     """
-    mapping = get_collection_mapping(collection_name)
-    if not mapping:
-        print(f"[TRANSFORMATION] No mapping found for collection: {collection_name}")
-        return pd.DataFrame()
-    
-    print(f"[TRANSFORMATION] Starting transformation for {len(source_df)} rows in collection: {collection_name}")
-    
-    # Initialize result dictionary to store transformed data
-    result_data = {}
-    
-    # Process each row in the source DataFrame
-    for idx, row in source_df.iterrows():
-        # Convert row to dict for easier nested access
-        row_dict = row.to_dict()
-        
-        # Reconstruct original document from normalized row for nested access
-        original_doc = {}
-        for col in row_dict:
-            if pd.notna(row_dict[col]):
-                # Handle nested field reconstruction
-                if '.' in col:
-                    keys = col.split('.')
-                    current = original_doc
-                    for key in keys[:-1]:
-                        if key not in current:
-                            current[key] = {}
-                        elif not isinstance(current[key], dict):
-                            # Field exists but isn't a dict, skip this path
-                            break
-                        current = current[key]
-                    if isinstance(current, dict):
-                        current[keys[-1]] = row_dict[col]
-                else:
-                    original_doc[col] = row_dict[col]
-        
-        # Apply each mapping rule
-        for target_field, mapping_spec in mapping.items():
-            try:
-                # Handle the mapping specification format (source_spec, transform_func)
-                if isinstance(mapping_spec, tuple) and len(mapping_spec) == 2:
-                    source_spec, transform_func = mapping_spec
-                else:
-                    # If it's not a tuple, treat it as source_spec with no transform
-                    source_spec = mapping_spec
-                    transform_func = None
-                
-                # Extract source value based on specification type
-                if callable(source_spec):
-                    # Check if it's a lambda that expects a document argument
-                    import inspect
-                    try:
-                        sig = inspect.signature(source_spec)
-                        num_params = len(sig.parameters)
-                        
-                        if num_params == 0:
-                            # No parameters (like datetime.now())
-                            source_value = source_spec()
-                        else:
-                            # Has parameters, pass the document
-                            # Use original_doc which has the nested structure
-                            source_value = source_spec(original_doc)
-                    except (TypeError, ValueError):
-                        # If we can't inspect, try with document first, then without
-                        try:
-                            source_value = source_spec(original_doc)
-                        except (TypeError, KeyError):
-                            try:
-                                source_value = source_spec()
-                            except:
-                                source_value = None
-                                
-                elif isinstance(source_spec, Literal):
-                    # Literal value
-                    source_value = source_spec.value
-                    
-                elif isinstance(source_spec, str):
-                    # Field path - check both flattened and nested access
-                    if source_spec in row_dict:
-                        # Direct access for pandas normalized fields
-                        source_value = row_dict[source_spec]
-                    else:
-                        # Try nested access on original document
-                        source_value = get_nested_value(original_doc, source_spec)
-                else:
-                    source_value = None
-                
-                # Apply transformation function if provided and value is not None
-                if transform_func and source_value is not None:
+    keys = tuple(path.split('.'))
+    
+    if len(keys) == 1:
+        key = keys[0]
+        return lambda doc: doc.get(key) if isinstance(doc, dict) else None
+    
+    def getter(doc):
+        current = doc
+        for key in keys:
+            if isinstance(current, dict) and key in current:
+                current = current[key]
+            else:
+                return None
+        return current
+    return getter
+
+def _compile_source(source_spec):
+    """Resolve a mapping source specification into a function of the document."""
+    if callable(source_spec):
+        # Decide once whether the callable takes the document (e.g. lambda doc: ...)
+        # or nothing (e.g. lambda: datetime.now()...)
+        try:
+            takes_document = len(inspect.signature(source_spec).parameters) > 0
+        except (TypeError, ValueError):
+            # If we can't inspect, try with document first, then without
+            def call_uninspectable(doc):
+                try:
+                    return source_spec(doc)
+                except (TypeError, KeyError):
                     try:
-                        transformed_value = transform_func(source_value)
-                    except Exception as e:
-                        print(f"[TRANSFORMATION] Transform function failed for {target_field}: {e}")
-                        transformed_value = None
-                else:
-                    transformed_value = source_value
-                
-                # Store in result
-                if target_field not in result_data:
-                    result_data[target_field] = []
-                result_data[target_field].append(transformed_value)
-                
-            except Exception as e:
-                print(f"[TRANSFORMATION] Error processing field {target_field}: {e}")
-                # Add None for failed transformations
-                if target_field not in result_data:
-                    result_data[target_field] = []
-                result_data[target_field].append(None)
-    
-    # Ensure all lists have the same length
-    if result_data:
-        max_length = max(len(values) for values in result_data.values())
-        for field, values in result_data.items():
-            while len(values) < max_length:
-                values.append(None)
+                        return source_spec()
+                    except Exception:
+                        return None
+            return call_uninspectable
+        
+        if takes_document:
+            return source_spec
+        return lambda doc: source_spec()
     
-    # Convert to DataFrame
-    transformed_df = pd.DataFrame(result_data)
+    if isinstance(source_spec, Literal):
+        value = source_spec.value
+        return lambda doc: value
     
-    print(f"[TRANSFORMATION] Transformed {len(source_df)} rows into {len(transformed_df)} rows for collection: {collection_name}")
-    if not transformed_df.empty:
-        print(f"[TRANSFORMATION] Output columns ({len(transformed_df.columns)}): {list(transformed_df.columns)[:10]}...")
+    if isinstance(source_spec, str):
+        return compile_path_getter(source_spec)
     
-    return transformed_df
+    return lambda doc: None
 
-def validate_transformation_result(df, schema):
+@functools.lru_cache(maxsize=None)
+def compile_mapping(collection_name, target_columns=None):
     """
-    Validate and auto-fix DataFrame to match target schema.
-    Logs issues but continues processing - prioritizing data capture over perfection.
+    Compile a collection's mapping into a list of (target_field, source_getter, transform_func,
+    source_key) rules. Specification parsing and signature inspection happen once per collection
+    rather than once per field per document. source_key is the document key for plain
+    top-level paths (read inline by transform_to_columns), None for any other source.
     
     Args:
-        df (pd.DataFrame): Transformed DataFrame
-        schema (pyarrow.Schema): Target PyArrow schema
+        collection_name (str): Name of the collection
+        target_columns (tuple, optional): Only compile rules for these target fields
         
     Returns:
-        tuple: (is_valid, fixed_df, warning_messages)
+        list: Compiled rules, empty if the collection has no mapping
     """
-    if df.empty:
-        return False, df, ["DataFrame is empty"]
-    
-    warnings = []
+    mapping = get_collection_mapping(collection_name)
+    if not mapping:
+        return []
     
-    try:
-        import pyarrow as pa
-        
-        # Create a copy to avoid modifying the original
-        fixed_df = df.copy()
+    wanted = set(target_columns) if target_columns is not None else None
+    rules = []
+    for target_field, mapping_spec in mapping.items():
+        if wanted is not None and target_field not in wanted:
+            continue
         
-        schema_fields = {field.name: field for field in schema}
-        df_columns = set(fixed_df.columns)
-        
-        # Handle missing required fields - add with None values
-        missing_fields = set(schema_fields.keys()) - df_columns
-        if missing_fields:
-            for field_name in missing_fields:
-                fixed_df[field_name] = None
-                field_type = schema_fields[field_name].type
-                warnings.append(f"SCHEMA_DRIFT: Added missing field '{field_name}' ({field_type}) with None")
-        
-        # Log extra fields that will be dropped
-        extra_fields = df_columns - set(schema_fields.keys())
-        if extra_fields:
-            warnings.append(f"SCHEMA_DRIFT: Dropping unexpected fields: {extra_fields}")
+        # Handle the mapping specification format (source_spec, transform_func)
+        if isinstance(mapping_spec, tuple) and len(mapping_spec) == 2:
+            source_spec, transform_func = mapping_spec
+        else:
+            # If it's not a tuple, treat it as source_spec with no transform
+            source_spec, transform_func = mapping_spec, None
         
-        # Reorder columns to match schema exactly and drop extra fields
-        fixed_df = fixed_df[[field.name for field in schema]]
+        source_key = source_spec if isinstance(source_spec, str) and '.' not in source_spec else None
+        rules.append((target_field, _compile_source(source_spec), transform_func, source_key))
+    return rules
+
+def _apply_rule(doc, target_field, get_source, transform_func):
+    """Apply one compiled rule to one document, returning None if it fails."""
+    try:
+        source_value = get_source(doc)
         
-        # Try to create PyArrow table with safe casting first
-        validation_success = False
-        try:
-            table = pa.Table.from_pandas(fixed_df, schema=schema, safe=True)
-            validation_success = True
-            
-            # Log any data quality issues
-            for col_idx, field in enumerate(schema):
-                col = table.column(col_idx)
-                if col.null_count > 0:
-                    null_pct = (col.null_count / len(col)) * 100
-                    if null_pct > 50:
-                        warnings.append(f"DATA_QUALITY: Field '{field.name}' has {null_pct:.1f}% null values")
-                        
-        except pa.lib.ArrowTypeError as e:
-            # Type mismatch - try to fix with lossy casting
-            warnings.append(f"TYPE_MISMATCH: {str(e)[:200]}")  # Truncate long error messages
-            
+        # Apply transformation function if provided and value is not None
+        if transform_func and source_value is not None:
             try:
-                # Try with safe=False to allow lossy casts
-                table = pa.Table.from_pandas(fixed_df, schema=schema, safe=False)
-                warnings.append("Applied lossy type casting to conform to schema")
-                validation_success = True
-            except Exception as cast_error:
-                # Even lossy casting failed - try to fix column by column
-                warnings.append(f"LOSSY_CAST_FAILED: {str(cast_error)[:200]}")
-                
-                # Identify and fix problematic columns
-                for field in schema:
-                    if field.name in fixed_df.columns:
-                        try:
-                            # Try to cast this specific column
-                            test_series = fixed_df[field.name]
-                            
-                            # Special handling for timestamp fields
-                            if pa.types.is_timestamp(field.type):
-                                # Try to convert to datetime, handling various formats
-                                fixed_df[field.name] = pd.to_datetime(test_series, errors='coerce')
-                            elif field.type == pa.string():
-                                # Convert to string, handling None values
-                                fixed_df[field.name] = test_series.apply(
-                                    lambda x: str(x) if x is not None else None
-                                )
-                            elif field.type == pa.int64():
-                                fixed_df[field.name] = pd.to_numeric(test_series, errors='coerce').astype('Int64')
-                            elif field.type == pa.float64():
-                                fixed_df[field.name] = pd.to_numeric(test_series, errors='coerce')
-                            elif field.type == pa.bool_():
-                                # Handle bool conversion more carefully
-                                fixed_df[field.name] = test_series.apply(
-                                    lambda x: bool(x) if x is not None else None
-                                )
-                            # Add more type handling as needed
-                        except Exception as col_error:
-                            # If casting fails, set to None
-                            warnings.append(f"COLUMN_CAST_FAILED: '{field.name}' - setting to None")
-                            fixed_df[field.name] = None
-                
-                # Try one more time after individual column fixes
-                try:
-                    table = pa.Table.from_pandas(fixed_df, schema=schema, safe=False)
-                    warnings.append("Fixed problematic columns individually")
-                    validation_success = True
-                except Exception as final_error:
-                    warnings.append(f"CRITICAL: Final validation failed: {str(final_error)[:200]}")
-                    validation_success = False
-        
-        if warnings:
-            print(f"[SCHEMA_VALIDATION] Warnings detected: {len(warnings)}")
-            for warning in warnings[:10]:  # Limit console output to first 10 warnings
-                print(f"  - {warning}")
-            if len(warnings) > 10:
-                print(f"  ... and {len(warnings) - 10} more warnings")
-        else:
-            print("[SCHEMA_VALIDATION] Clean validation - no issues detected")
-        
-        return validation_success, fixed_df, warnings
+                return transform_func(source_value)
+            except Exception as e:
+                logger.warning("[TRANSFORMATION] Transform function failed for %s: %s", target_field, e)
+                return None
+        return source_value
         
     except Exception as e:
-        error_msg = f"Critical validation error: {str(e)[:500]}"
-        print(f"[SCHEMA_VALIDATION] {error_msg}")
-        return False, df, [error_msg]
\ No newline at end of file
+        logger.warning("[TRANSFORMATION] Error processing field %s: %s", target_field, e)
+        # None for failed transformations
+        return None
+
+def transform_to_columns(documents, collection_name, target_columns=None):
+    """
+    Apply field mappings and transformations, returning the result column by column.
+    
+    Args:
+        documents (list): Raw (nested) documents
+        collection_name (str): Name of the collection being processed
+        target_columns (list, optional): Only these target fields are computed;
+            mapping rules for any other field are skipped
+        
+    Returns:
+        dict: Target field -> list of values (one per document), empty if no mapping exists
+    """
+    rules = compile_mapping(collection_name, tuple(target_columns) if target_columns is not None else None)
+    if not rules:
+        logger.warning("[TRANSFORMATION] No mapping found for collection: %s", collection_name)
+        return {}
+    
+    logger.debug("[TRANSFORMATION] Starting transformation for %d rows in collection: %s", len(documents), collection_name)
+    
+    # Column-oriented result: each target column is built in one pass over the documents
+    result_data = {}
+    for target_field, get_source, transform_func, source_key in rules:
+        try:
+            if source_key is not None:
+                # Top-level key: read it inline rather than calling the getter per document
+                values = [doc.get(source_key) for doc in documents]
+            else:
+                values = [get_source(doc) for doc in documents]
+            if transform_func:
+                values = [transform_func(value) if value is not None else None for value in values]
+        except Exception:
+            # Some document breaks this rule; redo the column value by value so that
+            # only the failing values become None
+            values = [_apply_rule(doc, target_field, get_source, transform_func) for doc in documents]
+        result_data[target_field] = values
+    
+    logger.debug("[TRANSFORMATION] Transformed %d documents into %d columns for collection: %s",
+                 len(documents), len(result_data), collection_name)
+    return result_data
@@ -1,56 +1,122 @@
 import os
 import json
-import base64
-import io
+import binascii
+import functools
+import logging
 import uuid
-from datetime import datetime, timezone
+import signal
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
 
+import orjson
 import pandas as pd
 import pyarrow as pa
 import pyarrow.parquet as pq
 from google.cloud import storage
-from google.cloud import logging
-from bson import json_util
+from requests.adapters import HTTPAdapter
+from google.cloud import logging as cloud_logging
+from bson import ObjectId, json_util
 from flask import Flask, request
+from flask.json.provider import DefaultJSONProvider
 
-from config.schema_mappings import get_collection_schema, get_available_collections, has_collection_support
-from config.transformer import apply_transformations
+from config.schema_mappings import get_collection_schema, get_available_collections
+from config.transformer import compile_mapping, transform_to_columns
+
+# Logging configuration
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
+    format='%(asctime)s - %(levelname)s - [%(name)s:%(funcName)s] - %(message)s',
+    force=True
+)
+logger = logging.getLogger(__name__)
 
 # Configuration
 PROJECT_ID = os.getenv("PROJECT_ID")
 GCS_PROCESSED_BUCKET_NAME = os.getenv("GCS_PROCESSED_BUCKET_NAME")
 
+# Schemas and mappings are static, so the supported collections are resolved once
+# (sorted, so that listings and the inference default do not depend on set order)
+AVAILABLE_COLLECTIONS = tuple(sorted(get_available_collections()))
+SUPPORTED_COLLECTIONS = frozenset(AVAILABLE_COLLECTIONS)
+
+# Every BSON extended-JSON wrapper ($oid, $date, $numberLong, ...) is a "$"-prefixed key
+EXTENDED_JSON_MARKER = b'"$'
+
+# Micro-batching: documents are buffered per collection and written as one
+# Parquet file once a batch is full or has been pending for too long.
+BATCH_MAX_ROWS = int(os.getenv("BATCH_MAX_ROWS", "8192"))
+BATCH_MAX_AGE_SECONDS = float(os.getenv("BATCH_MAX_AGE_SECONDS", "30"))
+# Batches flushed together are written and uploaded concurrently
+UPLOAD_MAX_WORKERS = int(os.getenv("UPLOAD_MAX_WORKERS", "32"))
+
+# Parquet writer settings: zstd level 1 is both smaller and about as fast as the
+# snappy default. Each file is written as a single row group (see write_documents_to_parquet).
+PARQUET_WRITE_OPTIONS = {
+    'compression': 'zstd',
+    'compression_level': 1,
+    'use_dictionary': True,
+    'write_statistics': False,
+}
+
+
+def parquet_write_options(schema):
+    """
+    Writer options for one collection's schema. Timestamp columns are delta-encoded:
+    change timestamps are high-cardinality but close together, so deltas come out
+    far smaller than dictionary pages. Every other column keeps dictionary encoding.
+    """
+    timestamp_fields = [field.name for field in schema if pa.types.is_timestamp(field.type)]
+    if not timestamp_fields:
+        return PARQUET_WRITE_OPTIONS
+    return {
+        **PARQUET_WRITE_OPTIONS,
+        'use_dictionary': [field.name for field in schema if field.name not in timestamp_fields],
+        'column_encoding': {name: 'DELTA_BINARY_PACKED' for name in timestamp_fields},
+    }
+
+
 if not PROJECT_ID:
-    print("WARNING: PROJECT_ID environment variable not set")
+    logger.warning("PROJECT_ID environment variable not set")
 if not GCS_PROCESSED_BUCKET_NAME:
-    print("WARNING: GCS_PROCESSED_BUCKET_NAME environment variable not set")
+    logger.warning("GCS_PROCESSED_BUCKET_NAME environment variable not set")
 
 # Initialize clients
 storage_client = storage.Client()
-app = Flask(__name__)
+# requests pools at most 10 connections per host by default; with more upload threads the
+# extra connections are dropped after each file and every upload pays a new TLS handshake
+storage_client._http.mount("https://", HTTPAdapter(pool_maxsize=UPLOAD_MAX_WORKERS))
+# Bucket handles are plain references (no API call), so one is shared by all threads
+processed_bucket = storage_client.bucket(GCS_PROCESSED_BUCKET_NAME) if GCS_PROCESSED_BUCKET_NAME else None
 
-# Initialize schema monitoring
-schema_monitor = None
-if PROJECT_ID:
-    try:
-        schema_monitor = logging.Client(project=PROJECT_ID).logger('schema-drift')
-        print("[MONITORING] Cloud Logging initialized for schema drift tracking")
-    except Exception as e:
-        print(f"[MONITORING] Warning: Could not initialize Cloud Logging: {e}")
-        schema_monitor = None
 
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson, used for push envelopes and JSON responses."""
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def dumps(self, obj, **kwargs):
+        option = orjson.OPT_SORT_KEYS if self.sort_keys else 0
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+
+
+app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 class SchemaMonitor:
     """Monitor and log schema drift events to Cloud Logging"""
     
     def __init__(self, project_id):
         try:
-            self.logging_client = logging.Client(project=project_id)
+            self.logging_client = cloud_logging.Client(project=project_id)
             self.logger = self.logging_client.logger('schema-drift')
             self.enabled = True
-            print("[MONITOR] Schema monitoring enabled")
+            logger.info("[MONITOR] Schema monitoring enabled")
         except Exception as e:
-            print(f"[MONITOR] Could not initialize monitoring: {e}")
+            logger.warning("[MONITOR] Could not initialize monitoring: %s", e)
             self.enabled = False
             self.logger = None
     
@@ -60,28 +126,106 @@ class SchemaMonitor:
             return
             
         try:
-            for warning in warnings:
-                severity = 'WARNING'
-                if 'CRITICAL' in warning:
-                    severity = 'ERROR'
-                elif 'DATA_QUALITY' in warning:
-                    severity = 'INFO'
-                elif 'TYPE_MISMATCH' in warning:
+            # All entries of one call are sent in a single write request
+            with self.logger.batch() as batch:
+                for warning in warnings:
                     severity = 'WARNING'
-                
-                log_entry = {
-                    'message': warning,
-                    'collection': collection,
-                    'severity': severity,
-                    'timestamp': datetime.utcnow().isoformat()
-                }
-                
-                if document_id:
-                    log_entry['document_id'] = document_id
-                
-                self.logger.log_struct(log_entry, severity=severity)
+                    if 'CRITICAL' in warning:
+                        severity = 'ERROR'
+                    elif 'DATA_QUALITY' in warning:
+                        severity = 'INFO'
+                    elif 'TYPE_MISMATCH' in warning:
+                        severity = 'WARNING'
+                    
+                    log_entry = {
+                        'message': warning,
+                        'collection': collection,
+                        'severity': severity,
+                        'timestamp': datetime.utcnow().isoformat()
+                    }
+                    
+                    if document_id:
+                        log_entry['document_id'] = document_id
+                    
+                    batch.log_struct(log_entry, severity=severity)
         except Exception as e:
-            print(f"[MONITOR] Failed to log to Cloud Logging: {e}")
+            logger.warning("[MONITOR] Failed to log to Cloud Logging: %s", e)
+
+
+# One monitor (and Cloud Logging client) for the process, shared by every transformer
+schema_monitor = SchemaMonitor(PROJECT_ID) if PROJECT_ID else None
+
+
+# Missing/extra field analysis only depends on the schema and the DataFrame columns,
+# which repeat for every batch of a collection: (id(schema), columns) -> result
+_SCHEMA_ALIGNMENT_CACHE = {}
+_SCHEMA_ALIGNMENT_CACHE_SIZE = 128
+_schema_alignment_lock = threading.Lock()
+
+
+def _schema_alignment(schema, columns):
+    """
+    Compare DataFrame columns against the target schema.
+    
+    Returns:
+        tuple: (missing_field_names, drift_warnings)
+    """
+    key = (id(schema), columns)
+    cached = _SCHEMA_ALIGNMENT_CACHE.get(key)
+    if cached is not None:
+        return cached
+    
+    schema_fields = {field.name: field for field in schema}
+    df_columns = set(columns)
+    warnings = []
+    
+    missing_fields = [name for name in schema_fields if name not in df_columns]
+    for field_name in missing_fields:
+        warnings.append(f"SCHEMA_DRIFT: Added missing field '{field_name}' ({schema_fields[field_name].type}) with None")
+    
+    # Log extra fields that will be dropped
+    extra_fields = df_columns - schema_fields.keys()
+    if extra_fields:
+        warnings.append(f"SCHEMA_DRIFT: Dropping unexpected fields: {extra_fields}")
+    
+    result = (tuple(missing_fields), tuple(warnings))
+    with _schema_alignment_lock:
+        if len(_SCHEMA_ALIGNMENT_CACHE) >= _SCHEMA_ALIGNMENT_CACHE_SIZE:
+            # Evict the oldest entry (dicts keep insertion order)
+            del _SCHEMA_ALIGNMENT_CACHE[next(iter(_SCHEMA_ALIGNMENT_CACHE))]
+        _SCHEMA_ALIGNMENT_CACHE[key] = result
+    return result
+
+
+def data_quality_warnings(table):
+    """Warn about columns that are mostly null in a converted table."""
+    num_rows = table.num_rows
+    warnings = []
+    for name, column in zip(table.schema.names, table.columns):
+        null_count = column.null_count
+        # Integer check for "more than 50% null"; the percentage is only formatted when warning
+        if null_count * 2 > num_rows:
+            warnings.append(f"DATA_QUALITY: Field '{name}' has {null_count / num_rows * 100:.1f}% null values")
+    return warnings
+
+
+def convert_values_individually(values, field_type):
+    """
+    Convert a column value by value, using null for each value that cannot be converted.
+    
+    Returns:
+        tuple: (pyarrow.Array, number of values set to null)
+    """
+    null = pa.scalar(None, type=field_type)
+    scalars = []
+    failed_count = 0
+    for value in values:
+        try:
+            scalars.append(pa.scalar(value, type=field_type, from_pandas=True))
+        except (pa.ArrowException, TypeError, ValueError, OverflowError):
+            scalars.append(null)
+            failed_count += 1
+    return pa.array(scalars, type=field_type), failed_count
 
 
 def validate_transformation_result(df, schema):
@@ -90,105 +234,144 @@ def validate_transformation_result(df, schema):
     Logs issues but continues processing.
     
     Returns:
-        tuple: (is_valid, fixed_df, warning_messages)
+        tuple: (is_valid, fixed_df, warning_messages, table) where table is the
+        schema-typed PyArrow Table built while validating (None if invalid)
     """
     if df.empty:
-        return False, df, ["DataFrame is empty"]
+        return False, df, ["DataFrame is empty"], None
     
     warnings = []
     
     try:
-        import pyarrow as pa
+        missing_fields, drift_warnings = _schema_alignment(schema, tuple(df.columns))
         
-        schema_fields = {field.name: field for field in schema}
-        df_columns = set(df.columns)
+        # Handle missing required fields - add with None values (in place on the caller's frame)
+        for field_name in missing_fields:
+            df[field_name] = None
+        warnings.extend(drift_warnings)
         
-        # Handle missing required fields - add with None values
-        missing_fields = set(schema_fields.keys()) - df_columns
-        if missing_fields:
-            for field_name in missing_fields:
-                df[field_name] = None
-                field_type = schema_fields[field_name].type
-                warnings.append(f"SCHEMA_DRIFT: Added missing field '{field_name}' ({field_type}) with None")
-        
-        # Log extra fields that will be dropped
-        extra_fields = df_columns - set(schema_fields.keys())
-        if extra_fields:
-            warnings.append(f"SCHEMA_DRIFT: Dropping unexpected fields: {extra_fields}")
-        
-        # Reorder columns to match schema exactly
-        df = df[[field.name for field in schema]]
+        # No reorder needed: from_pandas picks the columns by schema name, in schema order
         
         # Try to create PyArrow table with safe casting
         try:
-            table = pa.Table.from_pandas(df, schema=schema, safe=True)
+            table = pa.Table.from_pandas(df, schema=schema, safe=True, preserve_index=False)
             
             # Log any type casting that occurred
-            for col_idx, field in enumerate(schema):
-                col = table.column(col_idx)
-                if col.null_count > 0:
-                    null_pct = (col.null_count / len(col)) * 100
-                    if null_pct > 50:
-                        warnings.append(f"DATA_QUALITY: Field '{field.name}' has {null_pct:.1f}% null values")
+            warnings.extend(data_quality_warnings(table))
                         
-        except pa.lib.ArrowTypeError as e:
+        except (pa.ArrowTypeError, pa.ArrowInvalid) as e:
             warnings.append(f"TYPE_MISMATCH: {str(e)}")
             # Try with safe=False to allow lossy casts
-            table = pa.Table.from_pandas(df, schema=schema, safe=False)
-            warnings.append("TYPE_MISMATCH: Applied lossy type casting to conform to schema")
+            try:
+                table = pa.Table.from_pandas(df, schema=schema, safe=False, preserve_index=False)
+                warnings.append("TYPE_MISMATCH: Applied lossy type casting to conform to schema")
+            except (pa.ArrowTypeError, pa.ArrowInvalid) as e:
+                # Some value cannot be cast at all; the caller recovers column by column
+                warnings.append(f"TYPE_MISMATCH: Lossy casting failed: {str(e)}")
+                table = None
         
-        if warnings:
-            print(f"[SCHEMA_VALIDATION] Warnings detected: {len(warnings)}")
+        if warnings and logger.isEnabledFor(logging.DEBUG):
+            logger.debug("[SCHEMA_VALIDATION] Warnings detected: %d", len(warnings))
             for warning in warnings:
-                print(f"  - {warning}")
+                logger.debug("[SCHEMA_VALIDATION]   - %s", warning)
         
-        return True, df, warnings
+        return True, df, warnings, table
         
     except Exception as e:
-        return False, df, [f"CRITICAL: Validation error: {e}"]
+        return False, df, [f"CRITICAL: Validation error: {e}"], None
+
+
+def split_valid_documents(documents):
+    """
+    Keep only documents the mapping rules can read (JSON objects).
+    
+    Returns:
+        tuple: (valid_documents, rejected_count)
+    """
+    valid = [doc for doc in documents if isinstance(doc, dict)]
+    return valid, len(documents) - len(valid)
+
+
+# Structural fingerprints for documents that arrive without a collection field:
+# a document whose keys include every field of a rule belongs to that collection.
+# Rules are tried in order and rules for unsupported collections are dropped up front.
+_DETECTION_RULES = tuple(rule for rule in (
+    (frozenset({'email', 'subscription'}), 'customers'),
+    (frozenset({'email', 'createdAt'}), 'customers'),
+) if rule[1] in SUPPORTED_COLLECTIONS)
+_DETECTION_KEYS = frozenset().union(*(required_fields for required_fields, _ in _DETECTION_RULES))
+# Fingerprint (the document's keys that appear in any rule) -> first matching collection or None.
+# Documents of one collection share a handful of fingerprints, so this turns into one dict lookup.
+_detection_cache = {}
+
+
+def _match_detection_rules(fingerprint):
+    try:
+        return _detection_cache[fingerprint]
+    except KeyError:
+        match = next((collection for required_fields, collection in _DETECTION_RULES
+                      if required_fields <= fingerprint), None)
+        _detection_cache[fingerprint] = match
+        return match
+
+
+def determine_collection(sample):
+    """Infer the collection of a document (the first document of a message)"""
+    # From payload structure (MongoDB change stream format)
+    if isinstance(sample, dict):
+        if 'collection' in sample:
+            collection = sample['collection']
+            logger.debug("[COLLECTION_DETERMINATION] Found collection field: %s", collection)
+            return collection
+        
+        # Check document structure against known patterns
+        fingerprint = frozenset(_DETECTION_KEYS.intersection(sample))
+        collection = _match_detection_rules(fingerprint)
+        if collection is not None:
+            logger.debug("[COLLECTION_DETERMINATION] Inferred collection: %s (based on %s fields)", collection, sorted(fingerprint))
+            return collection
+        
+        # Try to match against any available collection
+        # This is a basic heuristic - you might want to enhance this
+        if AVAILABLE_COLLECTIONS:
+            default_collection = AVAILABLE_COLLECTIONS[0]
+            logger.info("[COLLECTION_DETERMINATION] Could not determine collection from structure, defaulting to: %s", default_collection)
+            return default_collection
+    
+    logger.info("[COLLECTION_DETERMINATION] Unable to determine collection, returning 'unknown'")
+    return 'unknown'
+
+
+# (epoch second, date path, file timestamp) of the last generated output path
+_path_timestamp_cache = (None, None, None)
+
+
+def _current_path_timestamps():
+    """Return the (YYYY-MM-DD, YYYYMMDD_HHMMSS) strings for now, formatted at most once per second."""
+    global _path_timestamp_cache
+    now = datetime.now(timezone.utc)
+    second = int(now.timestamp())
+    cached_second, date_path, timestamp = _path_timestamp_cache
+    if cached_second != second:
+        date_path = now.strftime("%Y-%m-%d")
+        timestamp = now.strftime("%Y%m%d_%H%M%S")
+        _path_timestamp_cache = (second, date_path, timestamp)
+    return date_path, timestamp
 
 
 class ParquetTransformer:
     def __init__(self, collection_name):
         self.collection_name = collection_name
         self.schema = get_collection_schema(collection_name)
-        self.monitor = SchemaMonitor(PROJECT_ID) if PROJECT_ID else None
+        self.monitor = schema_monitor
         
         if not self.schema:
             raise ValueError(f"No schema found for collection: {collection_name}")
-    
-    def determine_collection(self, data):
-        """Extract collection name from document or structure"""
-        if isinstance(data, list) and len(data) > 0:
-            sample = data[0]
-        else:
-            sample = data
-        
-        # From payload structure (MongoDB change stream format)
-        if isinstance(sample, dict):
-            if 'collection' in sample:
-                collection = sample['collection']
-                print(f"[COLLECTION_DETERMINATION] Found collection field: {collection}")
-                return collection
-            
-            # From document structure inference for available collections
-            available_collections = get_available_collections()
-            
-            # Check document structure against known patterns
-            if 'email' in sample and ('subscription' in sample or 'createdAt' in sample):
-                if 'customers' in available_collections:
-                    print("[COLLECTION_DETERMINATION] Inferred collection: customers (based on email + subscription/createdAt fields)")
-                    return 'customers'
-            
-            # Try to match against any available collection
-            # This is a basic heuristic - you might want to enhance this
-            if available_collections:
-                default_collection = available_collections[0]
-                print(f"[COLLECTION_DETERMINATION] Could not determine collection from structure, defaulting to: {default_collection}")
-                return default_collection
         
-        print("[COLLECTION_DETERMINATION] Unable to determine collection, returning 'unknown'")
-        return 'unknown'
+        # Resolved once: iterating a pa.Schema builds new Field/DataType wrappers every time
+        self._field_specs = tuple((field.name, field.type) for field in self.schema)
+        self.schema_field_names = [name for name, _ in self._field_specs]
+        self.parquet_write_options = parquet_write_options(self.schema)
     
     def transform_documents(self, documents):
         """
@@ -196,162 +379,71 @@ class ParquetTransformer:
         Resilient: logs issues but continues processing.
         """
         if not documents:
-            print("[TRANSFORMATION] No documents received for transformation.")
+            logger.warning("[TRANSFORMATION] No documents received for transformation.")
             return None
         
         if not isinstance(documents, list):
             documents = [documents]
         
-        print(f"[TRANSFORMATION] Starting transformation for {len(documents)} documents in collection: {self.collection_name}")
+        logger.debug("[TRANSFORMATION] Starting transformation for %d documents in collection: %s", len(documents), self.collection_name)
+        
+        # Reject malformed documents before any transformation work is spent on them
+        documents, rejected = split_valid_documents(documents)
+        if rejected:
+            rejection_warning = f"INVALID_DOCUMENT: Rejected {rejected} non-object documents"
+            logger.warning("[TRANSFORMATION] %s", rejection_warning)
+            if self.monitor:
+                self.monitor.log_drift(self.collection_name, [rejection_warning])
+        if not documents:
+            return None
         
         # Extract document ID for monitoring
-        doc_id = None
-        if documents and isinstance(documents[0], dict):
-            doc_id = documents[0].get('_id', 'unknown')
-        
-        # ==================== DEBUG LOGGING ====================
-        # Log the structure of the first document to understand what we're dealing with
-        if documents:
-            first_doc = documents[0]
-            print(f"[DEBUG] First document type: {type(first_doc)}")
-            print(f"[DEBUG] First document keys: {list(first_doc.keys())[:20] if isinstance(first_doc, dict) else 'Not a dict'}")
-            
-            # Check for specific problematic fields
-            if isinstance(first_doc, dict):
-                # Check subscription fields (customers)
-                if 'subscription' in first_doc and isinstance(first_doc['subscription'], dict):
-                    sub = first_doc['subscription']
-                    print(f"[DEBUG] subscription.stripeCustId type: {type(sub.get('stripeCustId'))}")
-                    print(f"[DEBUG] subscription.statusUpdatedAt type: {type(sub.get('statusUpdatedAt'))}")
-                    print(f"[DEBUG] subscription.isMixedPlan type: {type(sub.get('isMixedPlan'))}")
-                    if 'reasonForPause' in sub:
-                        print(f"[DEBUG] subscription.reasonForPause type: {type(sub.get('reasonForPause'))}")
-                
-                # Check address fields
-                if 'address' in first_doc and isinstance(first_doc['address'], dict):
-                    addr = first_doc['address']
-                    print(f"[DEBUG] address.line2 type: {type(addr.get('line2'))}")
-                    if isinstance(addr.get('line2'), list):
-                        print(f"[DEBUG] address.line2 is ARRAY with {len(addr.get('line2'))} elements")
-                
-                # Check acquisition field
-                if 'acquisition' in first_doc:
-                    print(f"[DEBUG] acquisition type: {type(first_doc.get('acquisition'))}")
-                    if isinstance(first_doc.get('acquisition'), list):
-                        print(f"[DEBUG] acquisition is ARRAY with {len(first_doc.get('acquisition'))} elements")
-                
-                # Log a sample of the document structure (first 500 chars)
-                doc_str = json.dumps(first_doc, default=str)[:500]
-                print(f"[DEBUG] Document sample: {doc_str}...")
-        # ==================== END DEBUG LOGGING ====================
+        doc_id = documents[0].get('_id', 'unknown')
+        
+        if logger.isEnabledFor(logging.DEBUG):
+            self._log_document_structure(documents[0])
         
         try:
-            # 1. Normalize raw JSON documents into a flat pandas DataFrame
-            source_df = pd.json_normalize(documents)
-            print(f"[TRANSFORMATION] Normalized to DataFrame with {source_df.shape[0]} rows and {source_df.shape[1]} columns")
-            print(f"[TRANSFORMATION] DataFrame columns: {list(source_df.columns)[:10]}..." if len(source_df.columns) > 10 else f"[TRANSFORMATION] DataFrame columns: {list(source_df.columns)}")
+            # 1. Apply declarative field mappings directly to the raw documents.
+            # Only the fields in the target schema are computed; the rest would be dropped anyway
+            columns = transform_to_columns(documents, self.collection_name,
+                                           target_columns=self.schema_field_names)
             
-            # 2. Apply declarative field mappings and transformations
-            transformed_df = apply_transformations(source_df, self.collection_name)
-            
-            if transformed_df.empty:
-                print(f"[TRANSFORMATION] ERROR: DataFrame is empty after transformations for collection: {self.collection_name}")
+            if not columns:
+                logger.error("[TRANSFORMATION] No columns after transformations for collection: %s", self.collection_name)
                 return None
             
-            print(f"[TRANSFORMATION] After transformations: {transformed_df.shape[0]} rows and {transformed_df.shape[1]} columns")
-            
-            # 3. Validate and fix transformation result
-            is_valid, fixed_df, warnings = validate_transformation_result(transformed_df, self.schema)
-            
-            if not is_valid:
-                print(f"[TRANSFORMATION] CRITICAL: Cannot proceed even with fixes: {warnings}")
-                # Log to monitoring
-                if self.monitor:
-                    self.monitor.log_drift(self.collection_name, warnings, doc_id)
-                return None
+            # 2. Build the Arrow table straight from the mapped values; pandas is only
+            # needed when some value does not fit its schema type and has to be coerced
+            table, warnings = self._table_from_columns(columns, len(documents))
+            if table is None:
+                table, warnings = self._table_from_dataframe(pd.DataFrame(columns), doc_id)
+                if table is None:
+                    return None
             
             if warnings:
                 # Log warnings to monitoring system
-                print(f"[TRANSFORMATION] Processing with {len(warnings)} warnings")
+                logger.warning("[TRANSFORMATION] Processing with %d warnings", len(warnings))
                 if self.monitor:
                     self.monitor.log_drift(self.collection_name, warnings, doc_id)
             
-            # 4. Convert to PyArrow Table
-            try:
-                # Use fixed DataFrame that has been aligned with schema
-                table = pa.Table.from_pandas(fixed_df, schema=self.schema, safe=False)
-                
-                print(f"[TABLE_CREATION] SUCCESS: Created PyArrow Table for {self.collection_name}")
-                print(f"  - Rows: {table.num_rows}, Columns: {table.num_columns}")
-                if warnings:
-                    print(f"  - Schema drift detected: {len(warnings)} issues logged")
-                
-                # Add metadata about schema drift to the table
-                if warnings:
-                    metadata = {
-                        b'schema_drift_count': str(len(warnings)).encode(),
-                        b'schema_drift_summary': '; '.join(warnings[:3]).encode()  # First 3 warnings
-                    }
-                    existing_metadata = table.schema.metadata or {}
-                    combined_metadata = {**existing_metadata, **metadata}
-                    table = table.replace_schema_metadata(combined_metadata)
-                
-                return table
-                
-            except Exception as e:
-                print(f"[TABLE_CREATION] FALLBACK: Error creating table, attempting recovery: {e}")
-                fallback_warning = f"CRITICAL: Table creation failed, attempting recovery: {str(e)}"
-                if self.monitor:
-                    self.monitor.log_drift(self.collection_name, [fallback_warning], doc_id)
-                
-                # Last resort: try to save what we can
-                try:
-                    # Drop problematic columns one by one until it works
-                    working_df = fixed_df.copy()
-                    dropped_columns = []
-                    
-                    for col in fixed_df.columns:
-                        try:
-                            test_df = working_df[[col]]
-                            pa.Table.from_pandas(test_df, schema=pa.schema([field for field in self.schema if field.name == col]))
-                        except:
-                            print(f"[TABLE_CREATION] Dropping problematic column: {col}")
-                            dropped_columns.append(col)
-                            working_df = working_df.drop(columns=[col])
-                    
-                    if not working_df.empty:
-                        partial_schema = pa.schema([field for field in self.schema if field.name in working_df.columns])
-                        table = pa.Table.from_pandas(working_df, schema=partial_schema)
-                        
-                        success_msg = f"PARTIAL SUCCESS: Saved {len(working_df.columns)}/{len(fixed_df.columns)} columns"
-                        print(f"[TABLE_CREATION] {success_msg}")
-                        
-                        if dropped_columns and self.monitor:
-                            drop_warning = f"RECOVERY: Dropped columns due to errors: {dropped_columns}"
-                            self.monitor.log_drift(self.collection_name, [drop_warning], doc_id)
-                        
-                        # Add recovery metadata
-                        metadata = {
-                            b'recovery_mode': b'true',
-                            b'dropped_columns': ','.join(dropped_columns).encode(),
-                            b'original_column_count': str(len(fixed_df.columns)).encode()
-                        }
-                        table = table.replace_schema_metadata(metadata)
-                        
-                        return table
-                except Exception as recovery_error:
-                    print(f"[TABLE_CREATION] RECOVERY FAILED: {recovery_error}")
-                    if self.monitor:
-                        self.monitor.log_drift(self.collection_name, 
-                                              [f"CRITICAL: Recovery failed: {str(recovery_error)}"], 
-                                              doc_id)
-                
-                return None
+            logger.debug("[TABLE_CREATION] SUCCESS: Created PyArrow Table for %s (%d rows, %d columns, %d drift issues)",
+                        self.collection_name, table.num_rows, table.num_columns, len(warnings))
+            
+            # Add metadata about schema drift to the table
+            if warnings:
+                metadata = {
+                    b'schema_drift_count': str(len(warnings)).encode(),
+                    b'schema_drift_summary': '; '.join(warnings[:3]).encode()  # First 3 warnings
+                }
+                existing_metadata = table.schema.metadata or {}
+                combined_metadata = {**existing_metadata, **metadata}
+                table = table.replace_schema_metadata(combined_metadata)
+            
+            return table
                 
         except Exception as e:
-            print(f"[TRANSFORMATION] CRITICAL ERROR: Transformation failed for collection '{self.collection_name}': {e}")
-            import traceback
-            print(f"[TRANSFORMATION] Traceback: {traceback.format_exc()}")
+            logger.exception("[TRANSFORMATION] CRITICAL ERROR: Transformation failed for collection '%s': %s", self.collection_name, e)
             
             if self.monitor:
                 self.monitor.log_drift(self.collection_name, 
@@ -359,177 +451,539 @@ class ParquetTransformer:
                                       doc_id)
             return None
     
+    def _table_from_columns(self, columns, num_rows):
+        """
+        Convert mapped column values directly to a schema-typed PyArrow Table.
+        
+        Returns:
+            tuple: (table, warnings), or (None, None) if a value needs coercion
+        """
+        _, drift_warnings = _schema_alignment(self.schema, tuple(columns))
+        
+        arrays = []
+        for name, field_type in self._field_specs:
+            values = columns.get(name)
+            try:
+                if values is None:
+                    arrays.append(pa.nulls(num_rows, type=field_type))
+                else:
+                    arrays.append(pa.array(values, type=field_type, from_pandas=True))
+            except (pa.ArrowException, TypeError, ValueError, OverflowError) as e:
+                logger.debug("[TABLE_CREATION] Field '%s' needs coercion, using DataFrame path: %s", name, e)
+                return None, None
+        
+        table = pa.Table.from_arrays(arrays, schema=self.schema)
+        return table, list(drift_warnings) + data_quality_warnings(table)
+    
+    def _table_from_dataframe(self, transformed_df, doc_id):
+        """
+        Validate, fix and convert a transformed DataFrame, dropping columns that cannot
+        be converted as a last resort.
+        
+        Returns:
+            tuple: (table or None, warnings)
+        """
+        # Validate and fix transformation result. Validation already converts the
+        # aligned DataFrame, so its table is used as is
+        is_valid, fixed_df, warnings, table = validate_transformation_result(transformed_df, self.schema)
+        
+        if not is_valid:
+            logger.error("[TRANSFORMATION] CRITICAL: Cannot proceed even with fixes: %s", warnings)
+            # Log to monitoring
+            if self.monitor:
+                self.monitor.log_drift(self.collection_name, warnings, doc_id)
+            return None, warnings
+        
+        if table is not None:
+            return table, warnings
+        
+        logger.warning("[TABLE_CREATION] FALLBACK: Error creating table, attempting recovery: %s", warnings[-1])
+        fallback_warning = f"CRITICAL: Table creation failed, attempting recovery: {warnings[-1]}"
+        if self.monitor:
+            self.monitor.log_drift(self.collection_name, warnings + [fallback_warning], doc_id)
+        
+        # Last resort: try to save what we can
+        try:
+            # Convert column by column. A column that fails as a whole is converted value
+            # by value, so a bad value only nulls its own cell instead of the column for
+            # every document in the batch; the column is dropped only if even that fails
+            kept_fields, kept_columns, dropped_columns, nulled_values = [], [], [], []
+            
+            for field in self.schema:
+                try:
+                    column = pa.Table.from_pandas(fixed_df[[field.name]], schema=pa.schema([field])).column(0)
+                except (pa.ArrowException, TypeError, ValueError, OverflowError):
+                    try:
+                        column, failed_count = convert_values_individually(fixed_df[field.name], field.type)
+                    except (pa.ArrowException, TypeError, ValueError, OverflowError):
+                        logger.warning("[TABLE_CREATION] Dropping problematic column: %s", field.name)
+                        dropped_columns.append(field.name)
+                        continue
+                    logger.warning("[TABLE_CREATION] Set %d unconvertible values to null in column: %s",
+                                   failed_count, field.name)
+                    nulled_values.append(f"{field.name}:{failed_count}")
+                kept_fields.append(field)
+                kept_columns.append(column)
+            
+            if kept_columns:
+                table = pa.Table.from_arrays(kept_columns, schema=pa.schema(kept_fields))
+                
+                success_msg = f"PARTIAL SUCCESS: Saved {len(kept_columns)}/{len(fixed_df.columns)} columns"
+                logger.warning("[TABLE_CREATION] %s", success_msg)
+                
+                if self.monitor:
+                    recovery_warnings = []
+                    if dropped_columns:
+                        recovery_warnings.append(f"RECOVERY: Dropped columns due to errors: {dropped_columns}")
+                    if nulled_values:
+                        recovery_warnings.append(f"RECOVERY: Set unconvertible values to null: {nulled_values}")
+                    if recovery_warnings:
+                        self.monitor.log_drift(self.collection_name, recovery_warnings, doc_id)
+                
+                # Add recovery metadata
+                metadata = {
+                    b'recovery_mode': b'true',
+                    b'dropped_columns': ','.join(dropped_columns).encode(),
+                    b'nulled_values': ','.join(nulled_values).encode(),
+                    b'original_column_count': str(len(fixed_df.columns)).encode()
+                }
+                return table.replace_schema_metadata(metadata), []
+        except Exception as recovery_error:
+            logger.error("[TABLE_CREATION] RECOVERY FAILED: %s", recovery_error)
+            if self.monitor:
+                self.monitor.log_drift(self.collection_name, 
+                                      [f"CRITICAL: Recovery failed: {str(recovery_error)}"], 
+                                      doc_id)
+        
+        return None, warnings
+    
+    def _log_document_structure(self, first_doc):
+        """Debug-only dump of the fields that most often break the transformation"""
+        logger.debug("[DEBUG] First document type: %s", type(first_doc))
+        if not isinstance(first_doc, dict):
+            return
+        logger.debug("[DEBUG] First document keys: %s", list(first_doc.keys())[:20])
+        
+        # Check subscription fields (customers)
+        sub = first_doc.get('subscription')
+        if isinstance(sub, dict):
+            logger.debug("[DEBUG] subscription.stripeCustId type: %s", type(sub.get('stripeCustId')))
+            logger.debug("[DEBUG] subscription.statusUpdatedAt type: %s", type(sub.get('statusUpdatedAt')))
+            logger.debug("[DEBUG] subscription.isMixedPlan type: %s", type(sub.get('isMixedPlan')))
+            if 'reasonForPause' in sub:
+                logger.debug("[DEBUG] subscription.reasonForPause type: %s", type(sub.get('reasonForPause')))
+        
+        # Check address fields
+        addr = first_doc.get('address')
+        if isinstance(addr, dict):
+            logger.debug("[DEBUG] address.line2 type: %s", type(addr.get('line2')))
+        
+        # Check acquisition field
+        if 'acquisition' in first_doc:
+            logger.debug("[DEBUG] acquisition type: %s", type(first_doc.get('acquisition')))
+        
+        # Log a sample of the document structure (first 500 chars)
+        logger.debug("[DEBUG] Document sample: %s...", orjson.dumps(first_doc, default=str, option=orjson.OPT_NON_STR_KEYS)[:500].decode(errors="ignore"))
+    
     def generate_output_path(self, operation="unknown"):
         """Generate GCS output path with a random prefix to prevent hotspotting."""
-        now = datetime.now(timezone.utc)
-        date_path = now.strftime("%Y-%m-%d")
-        timestamp = now.strftime("%Y%m%d_%H%M%S")
-        unique_id = uuid.uuid4().hex[:8]
-        random_prefix = uuid.uuid4().hex[:8]
+        date_path, timestamp = _current_path_timestamps()
+        random_hex = uuid.uuid4().hex
+        random_prefix, unique_id = random_hex[:8], random_hex[8:16]
         
         return f"processed/{self.collection_name}/{random_prefix}-{date_path}/{operation}_{timestamp}_{unique_id}.parquet"
 
 
+@functools.lru_cache(maxsize=None)
+def get_transformer(collection_name):
+    """Return the shared ParquetTransformer for a collection (schema and monitor are built once)."""
+    return ParquetTransformer(collection_name)
+
+
+def _log_message_structure(message_data):
+    """Debug-only description of an incoming change stream message"""
+    logger.debug("[MESSAGE_STRUCTURE] Raw message_data type: %s", type(message_data))
+    
+    if isinstance(message_data, dict):
+        logger.debug("[MESSAGE_STRUCTURE] Message keys: %s", list(message_data.keys()))
+        for key in ('operation', 'collection', 'database', 'timestamp', 'correlation_id'):
+            if key in message_data:
+                logger.debug("[MESSAGE_STRUCTURE] %s: %s", key, message_data[key])
+        
+        # Log document structure
+        doc = message_data.get('document')
+        if isinstance(doc, dict):
+            logger.debug("[MESSAGE_STRUCTURE] document keys (%d total): %s...", len(doc), list(doc.keys())[:15])
+            sub = doc.get('subscription')
+            if isinstance(sub, dict) and 'stripeCustId' in sub:
+                logger.debug("[MESSAGE_STRUCTURE] document.subscription.stripeCustId type: %s", type(sub['stripeCustId']))
+            if '_id' in doc:
+                logger.debug("[MESSAGE_STRUCTURE] document._id: %s", doc['_id'])
+        elif isinstance(doc, list):
+            logger.debug("[MESSAGE_STRUCTURE] document is a LIST with %d items", len(doc))
+    
+    elif isinstance(message_data, list):
+        logger.debug("[MESSAGE_STRUCTURE] Message is a LIST with %d items", len(message_data))
+        if message_data and isinstance(message_data[0], dict):
+            logger.debug("[MESSAGE_STRUCTURE] First item keys: %s...", list(message_data[0].keys())[:10])
+
+
+def _extract_documents(message_data):
+    """
+    Split a change stream message into its documents, collection and operation.
+    
+    Returns:
+        tuple: (documents, collection_name, operation); names default to 'unknown'
+    """
+    if type(message_data) is dict:
+        collection_name = message_data.get('collection', 'unknown')
+        if 'document' in message_data:
+            # MongoDB change stream format
+            return [message_data['document']], collection_name, message_data.get('operation', 'unknown')
+        # The whole message_data is the document (possibly carrying collection info)
+        return [message_data], collection_name, 'unknown'
+    if type(message_data) is list:
+        return message_data, 'unknown', 'unknown'
+    return [message_data], 'unknown', 'unknown'
+
+
 def process_pubsub_message_to_parquet(message_data):
     """Process Pub/Sub message and convert to parquet"""
     try:
-        # ==================== MESSAGE STRUCTURE LOGGING ====================
-        print(f"[MESSAGE_STRUCTURE] ============ BEGIN MESSAGE ANALYSIS ============")
-        print(f"[MESSAGE_STRUCTURE] Raw message_data type: {type(message_data)}")
+        if logger.isEnabledFor(logging.DEBUG):
+            _log_message_structure(message_data)
         
-        if isinstance(message_data, dict):
-            print(f"[MESSAGE_STRUCTURE] Message keys: {list(message_data.keys())}")
-            
-            # Log structure of key fields
-            if 'operation' in message_data:
-                print(f"[MESSAGE_STRUCTURE] operation: {message_data['operation']}")
-            if 'collection' in message_data:
-                print(f"[MESSAGE_STRUCTURE] collection: {message_data['collection']}")
-            if 'database' in message_data:
-                print(f"[MESSAGE_STRUCTURE] database: {message_data['database']}")
-            if 'timestamp' in message_data:
-                print(f"[MESSAGE_STRUCTURE] timestamp: {message_data['timestamp']}")
-            if 'correlation_id' in message_data:
-                print(f"[MESSAGE_STRUCTURE] correlation_id: {message_data['correlation_id']}")
-            
-            # Log document structure
-            if 'document' in message_data:
-                doc = message_data['document']
-                print(f"[MESSAGE_STRUCTURE] document type: {type(doc)}")
-                if isinstance(doc, dict):
-                    print(f"[MESSAGE_STRUCTURE] document keys ({len(doc.keys())} total): {list(doc.keys())[:15]}...")
-                    
-                    # Sample specific fields that are problematic
-                    if 'subscription' in doc:
-                        print(f"[MESSAGE_STRUCTURE] document.subscription exists, type: {type(doc['subscription'])}")
-                        if isinstance(doc['subscription'], dict) and 'stripeCustId' in doc['subscription']:
-                            stripe_id = doc['subscription']['stripeCustId']
-                            print(f"[MESSAGE_STRUCTURE] document.subscription.stripeCustId type: {type(stripe_id)}, value: {stripe_id if not isinstance(stripe_id, list) else f'ARRAY[{len(stripe_id)}]'}")
-                    
-                    if '_id' in doc:
-                        print(f"[MESSAGE_STRUCTURE] document._id: {doc['_id']}")
-                        
-                elif isinstance(doc, list):
-                    print(f"[MESSAGE_STRUCTURE] document is a LIST with {len(doc)} items")
-                    if doc:
-                        print(f"[MESSAGE_STRUCTURE] First document item type: {type(doc[0])}")
-                        if isinstance(doc[0], dict):
-                            print(f"[MESSAGE_STRUCTURE] First document item keys: {list(doc[0].keys())[:10]}...")
-                            
-        elif isinstance(message_data, list):
-            print(f"[MESSAGE_STRUCTURE] Message is a LIST with {len(message_data)} items")
-            if message_data:
-                print(f"[MESSAGE_STRUCTURE] First item type: {type(message_data[0])}")
-                if isinstance(message_data[0], dict):
-                    print(f"[MESSAGE_STRUCTURE] First item keys: {list(message_data[0].keys())[:10]}...")
-        
-        print(f"[MESSAGE_STRUCTURE] ============ END MESSAGE ANALYSIS ============")
-        # ==================== END MESSAGE STRUCTURE LOGGING ====================
-        
-        # Extract documents from your change stream format
-        documents = []
-        collection_name = "unknown"
-        operation = "unknown"
-        
-        print(f"[PROCESS_MESSAGE] Processing message data of type: {type(message_data)}")
-        
-        # Handle your MongoDB change stream message format
-        if isinstance(message_data, dict):
-            if 'document' in message_data:
-                documents = [message_data['document']]
-                collection_name = message_data.get('collection', 'unknown')
-                operation = message_data.get('operation', 'unknown')
-                print(f"[PROCESS_MESSAGE] Extracted from change stream format - collection: {collection_name}, operation: {operation}")
-            elif 'collection' in message_data:
-                # If the whole message_data is the document with collection info
-                collection_name = message_data.get('collection', 'unknown')
-                documents = [message_data]
-                print(f"[PROCESS_MESSAGE] Document contains collection info: {collection_name}")
-            else:
-                # Assume the whole message_data is a single document
-                documents = [message_data]
-                print("[PROCESS_MESSAGE] Treating message_data as single document")
-        elif isinstance(message_data, list):
-            documents = message_data
-            print(f"[PROCESS_MESSAGE] Processing list of {len(documents)} documents")
-        else:
-            documents = [message_data]
-            print("[PROCESS_MESSAGE] Converting message_data to list")
+        documents, collection_name, operation = _extract_documents(message_data)
         
         if not documents:
-            print("[PROCESS_MESSAGE] No documents to process")
+            logger.warning("[PROCESS_MESSAGE] No documents to process")
             return None
         
-        print(f"[PROCESS_MESSAGE] Extracted {len(documents)} documents, collection: {collection_name}, operation: {operation}")
+        logger.debug("[PROCESS_MESSAGE] Extracted %d documents, collection: %s, operation: %s", len(documents), collection_name, operation)
         
         # Determine collection if unknown
         if collection_name == "unknown":
-            transformer_temp = ParquetTransformer.__new__(ParquetTransformer)
-            collection_name = transformer_temp.determine_collection(documents)
-            print(f"[PROCESS_MESSAGE] Determined collection: {collection_name}")
+            collection_name = determine_collection(documents[0])
+            logger.debug("[PROCESS_MESSAGE] Determined collection: %s", collection_name)
         
         # Skip if no mapping available
-        if not has_collection_support(collection_name):
-            available = get_available_collections()
-            print(f"[PROCESS_MESSAGE] Skipping unsupported collection: {collection_name}. Available collections: {available}")
+        if collection_name not in SUPPORTED_COLLECTIONS:
+            logger.info("[PROCESS_MESSAGE] Skipping unsupported collection: %s (see /debug for available collections)",
+                        collection_name)
             return f"skipped_{collection_name}"
         
-        # Initialize transformer
-        try:
-            print(f"[PROCESS_MESSAGE] Initializing transformer for collection: {collection_name}")
-            transformer = ParquetTransformer(collection_name)
-        except ValueError as e:
-            print(f"[PROCESS_MESSAGE] Failed to initialize transformer: {e}")
-            return None
+        # Hand the documents to the batcher; a file is only written once the batch is full
+        batch = document_batcher.add(collection_name, operation, documents)
+        if batch is None:
+            return f"buffered_{collection_name}"
         
-        # Transform to parquet
-        print(f"[PROCESS_MESSAGE] Starting document transformation")
-        table = transformer.transform_documents(documents)
-        if table is None:
-            print("[PROCESS_MESSAGE] No data to transform or transformation failed")
-            return None
+        if document_batcher.closed:
+            # Shutting down: the worker may exit before a queued write runs, so write
+            # before the push is acknowledged
+            return write_documents_to_parquet(collection_name, operation, batch)
         
-        print(f"[PROCESS_MESSAGE] Transformation successful - {table.num_rows} rows, {table.num_columns} columns")
+        # Write the full batch off the request thread so the push is acknowledged
+        # without waiting on the GCS round trip
+        logger.debug("[PROCESS_MESSAGE] Batch full for %s, queueing %d documents for writing", collection_name, len(batch))
+        future = upload_executor.submit(write_documents_to_parquet, collection_name, operation, batch)
+        future.add_done_callback(_log_write_failure)
+        return f"queued_{collection_name}"
         
-        # Generate output path
-        output_path = transformer.generate_output_path(operation)
-        print(f"[GCS_UPLOAD] Generated output path: {output_path}")
+    except Exception as e:
+        logger.exception("[PROCESS_MESSAGE] CRITICAL ERROR: Failed to process message to parquet: %s", e)
+        raise
+
+
+def _log_write_failure(future):
+    """Done-callback for queued batch writes, which have no caller to raise to."""
+    error = future.exception()
+    if error is not None:
+        logger.error("[PROCESS_MESSAGE] ERROR: Queued batch write failed: %s", error, exc_info=error)
+
+
+def write_documents_to_parquet(collection_name, operation, documents):
+    """Transform a batch of documents and upload it to GCS as a single Parquet file"""
+    # Initialize transformer
+    try:
+        transformer = get_transformer(collection_name)
+    except ValueError as e:
+        logger.error("[PROCESS_MESSAGE] Failed to initialize transformer: %s", e)
+        return None
+    
+    # Transform to parquet
+    table = transformer.transform_documents(documents)
+    if table is None:
+        logger.warning("[PROCESS_MESSAGE] No data to transform or transformation failed")
+        return None
+    
+    # Generate output path
+    output_path = transformer.generate_output_path(operation)
+    
+    # Upload to GCS
+    if processed_bucket is None:
+        logger.error("[GCS_UPLOAD] GCS_PROCESSED_BUCKET_NAME not configured")
+        return None
+    
+    try:
+        blob = processed_bucket.blob(output_path)
         
-        # Upload to GCS
-        if not GCS_PROCESSED_BUCKET_NAME:
-            print("[GCS_UPLOAD] ERROR: GCS_PROCESSED_BUCKET_NAME not configured")
-            return None
+        # Serialize into an Arrow-native sink: the C++ writer appends to one growing
+        # buffer without calling back into Python for every page
+        sink = pa.BufferOutputStream()
+        # A batch can overshoot BATCH_MAX_ROWS by one message, so size the row group to the table
+        pq.write_table(table, sink, row_group_size=max(1, table.num_rows), **transformer.parquet_write_options)
+        parquet_bytes = sink.getvalue()
+        parquet_size = parquet_bytes.size
+        # The Parquet bytes are all we need from here on; free the Arrow buffers before the upload
+        del table, sink
+        logger.debug("[GCS_UPLOAD] Uploading %d bytes to gs://%s/%s", parquet_size, GCS_PROCESSED_BUCKET_NAME, output_path)
+        # Without a size the client falls back to a multi-request resumable upload;
+        # with it, files up to 8 MB go up in a single multipart request
+        blob.upload_from_file(pa.BufferReader(parquet_bytes), size=parquet_size,
+                              content_type='application/octet-stream')
         
-        try:
-            bucket = storage_client.bucket(GCS_PROCESSED_BUCKET_NAME)
-            blob = bucket.blob(output_path)
-            
-            # Convert table to bytes
-            print(f"[BUFFER_WRITE] Converting table to Parquet bytes")
-            buffer = io.BytesIO()
-            pq.write_table(table, buffer)
-            buffer.seek(0)
-            buffer_size = buffer.getbuffer().nbytes
-            print(f"[BUFFER_WRITE] SUCCESS: Created Parquet buffer of {buffer_size} bytes")
-            
-            print(f"[GCS_UPLOAD] Uploading {buffer_size} bytes to gs://{GCS_PROCESSED_BUCKET_NAME}/{output_path}")
-            blob.upload_from_file(buffer, content_type='application/octet-stream')
-            print(f"[GCS_UPLOAD] SUCCESS: Uploaded to gs://{GCS_PROCESSED_BUCKET_NAME}/{output_path}")
+    except Exception as e:
+        logger.exception("[GCS_UPLOAD] ERROR: Failed to upload to GCS: %s", e)
+        return None
+    
+    # The one INFO line per written file
+    logger.info("[PROCESS_MESSAGE] Wrote %d %s documents (%s, %d bytes) to gs://%s/%s",
+                len(documents), collection_name, operation, parquet_size, GCS_PROCESSED_BUCKET_NAME, output_path)
+    return output_path
+
+
+class DocumentBatcher:
+    """
+    Buffer documents per (collection, operation) and write one Parquet file per batch.
+    A batch is flushed when it reaches max_rows, or by a background thread once it
+    has been pending for max_age_seconds. Once closed, nothing is buffered any more.
+    """
+    
+    def __init__(self, max_rows, max_age_seconds):
+        self.max_rows = max(1, max_rows)
+        self.max_age_seconds = max_age_seconds
+        self._buffers = defaultdict(list)
+        self._first_buffered_at = {}
+        self._lock = threading.Lock()
+        self._flusher = None
+        self.closed = False
+    
+    def add(self, collection_name, operation, documents):
+        """
+        Buffer documents. Returns the full batch for the caller to write, or None while it
+        is still filling. After close() the documents are returned straight away.
+        """
+        key = (collection_name, operation)
+        with self._lock:
+            if self.closed:
+                return list(documents)
+            buffer = self._buffers[key]
+            if not buffer:
+                self._first_buffered_at[key] = time.monotonic()
+            buffer.extend(documents)
             
-        except Exception as e:
-            print(f"[GCS_UPLOAD] ERROR: Failed to upload to GCS: {e}")
-            import traceback
-            print(f"[GCS_UPLOAD] Traceback: {traceback.format_exc()}")
-            return None
+            batch = None
+            if len(buffer) >= self.max_rows:
+                batch = self._pop(key)
+            else:
+                self._ensure_flusher()
+        
+        if batch is None:
+            logger.debug("[BATCHER] Buffered %d %s documents (%d pending)", len(documents), collection_name, len(buffer))
+        return batch
+    
+    def flush(self, force=False):
+        """Write every batch older than max_age_seconds (or all batches when force=True)."""
+        now = time.monotonic()
+        with self._lock:
+            keys = [key for key, first_at in self._first_buffered_at.items()
+                    if force or now - first_at >= self.max_age_seconds]
+            batches = [(key, self._pop(key)) for key in keys]
         
-        print(f"[PROCESS_MESSAGE] Successfully processed {len(documents)} {collection_name} documents to {output_path}")
-        return output_path
+        futures = {}
+        for (collection_name, operation), batch in batches:
+            logger.debug("[BATCHER] Flushing %d %s documents (%s)", len(batch), collection_name, operation)
+            future = upload_executor.submit(write_documents_to_parquet, collection_name, operation, batch)
+            futures[future] = collection_name
         
-    except Exception as e:
-        print(f"[PROCESS_MESSAGE] CRITICAL ERROR: Failed to process message to parquet: {e}")
-        import traceback
-        print(f"[PROCESS_MESSAGE] Traceback: {traceback.format_exc()}")
-        raise
+        # Wait for every upload so a flush only returns once its batches are in GCS
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                logger.exception("[BATCHER] ERROR: Failed to flush %s batch: %s", futures[future], e)
+    
+    def close(self):
+        """Stop buffering and write every pending batch."""
+        with self._lock:
+            self.closed = True
+        self.flush(force=True)
+    
+    def pending_counts(self):
+        with self._lock:
+            return {f"{collection}/{operation}": len(docs) for (collection, operation), docs in self._buffers.items()}
+    
+    def _pop(self, key):
+        self._first_buffered_at.pop(key, None)
+        return self._buffers.pop(key, [])
+    
+    def _ensure_flusher(self):
+        # Started lazily so that the thread lives in the process that serves requests
+        if self._flusher is None or not self._flusher.is_alive():
+            self._flusher = threading.Thread(target=self._run_flusher, name="batch-flusher", daemon=True)
+            self._flusher.start()
+    
+    def _run_flusher(self):
+        while True:
+            # Sleep until the oldest batch expires, so no batch waits longer than max_age_seconds
+            # (a new batch can only expire later than a full max_age_seconds sleep from now)
+            with self._lock:
+                oldest = min(self._first_buffered_at.values(), default=None)
+            if oldest is None:
+                wait = self.max_age_seconds
+            else:
+                wait = oldest + self.max_age_seconds - time.monotonic()
+            time.sleep(max(0.05, wait))
+            self.flush()
+
+
+# Worker threads are created on first submit, i.e. in the process serving requests
+upload_executor = ThreadPoolExecutor(max_workers=UPLOAD_MAX_WORKERS, thread_name_prefix="parquet-upload")
+document_batcher = DocumentBatcher(BATCH_MAX_ROWS, BATCH_MAX_AGE_SECONDS)
+
+
+def _flush_batches_on_sigterm(signum, frame):
+    """Flush all pending batches before the instance shuts down."""
+    logger.info("[BATCHER] SIGTERM received, flushing pending batches")
+    # gunicorn finishes in-flight requests after this handler returns; closing the
+    # batcher makes them write their documents themselves instead of buffering them
+    # where no flush would pick them up again
+    document_batcher.close()
+    if callable(_previous_sigterm_handler):
+        _previous_sigterm_handler(signum, frame)
+    else:
+        signal.signal(signum, signal.SIG_DFL)
+        os.kill(os.getpid(), signum)
+
+
+_previous_sigterm_handler = None
+if threading.current_thread() is threading.main_thread():
+    _previous_sigterm_handler = signal.getsignal(signal.SIGTERM)
+    signal.signal(signal.SIGTERM, _flush_batches_on_sigterm)
+
+
+def _warm_up():
+    """
+    Do the one-off work of the first request at startup: compile every collection's
+    mapping rules and open the authenticated connection to GCS.
+    """
+    started = time.monotonic()
+    for collection_name in AVAILABLE_COLLECTIONS:
+        schema = get_collection_schema(collection_name)
+        # Same cache key as ParquetTransformer.transform_documents uses
+        compile_mapping(collection_name, tuple(field.name for field in schema))
+    
+    if processed_bucket is not None:
+        try:
+            # Fetches the access token and sets up DNS/TLS for the upload connection pool.
+            # Best effort: a single attempt, so a GCS hiccup cannot stall worker boot
+            # for the default retry deadline (120s)
+            processed_bucket.exists(timeout=5, retry=None)
+        except Exception as e:
+            logger.warning("[STARTUP] Could not pre-connect to gs://%s: %s", GCS_PROCESSED_BUCKET_NAME, e)
+    
+    logger.info("[STARTUP] Warm-up finished in %.0f ms", (time.monotonic() - started) * 1000)
+
+
+_warm_up()
+
+
+class UnsupportedExtendedJson(ValueError):
+    """Raised for extended-JSON wrappers that only bson.json_util knows how to decode"""
+
+
+_BSON_EPOCH = datetime(1970, 1, 1)
+
+
+def _decode_extended_json_wrapper(key, value):
+    if key == '$oid':
+        return ObjectId(value)
+    if key == '$date':
+        # json_util.dumps writes relaxed ISO strings for post-1970 dates and
+        # {"$numberLong": ms} otherwise. Like json_util.loads, return naive UTC datetimes.
+        if isinstance(value, str):
+            parsed = datetime.fromisoformat(value)
+            if parsed.tzinfo is not None:
+                parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+            return parsed
+        if isinstance(value, dict) and '$numberLong' in value:
+            value = int(value['$numberLong'])
+        if isinstance(value, int):
+            return _BSON_EPOCH + timedelta(milliseconds=value)
+    if key in ('$numberLong', '$numberInt'):
+        return int(value)
+    if key == '$numberDouble':
+        return float(value)
+    raise UnsupportedExtendedJson(key)
+
+
+def decode_extended_json(value):
+    """
+    Replace the extended-JSON wrappers ($oid, $date, $numberLong, ...) in an
+    orjson-parsed document with their Python values, in place.
+    Raises UnsupportedExtendedJson for any other "$" wrapper, including the
+    multi-key ones ($ref/$id, $code/$scope, legacy $binary/$type and $regex/$options).
+    """
+    if isinstance(value, dict):
+        if len(value) == 1:
+            key = next(iter(value))
+            if key[:1] == '$':
+                return _decode_extended_json_wrapper(key, value[key])
+        for key, item in value.items():
+            if key[:1] == '$':
+                raise UnsupportedExtendedJson(key)
+            if isinstance(item, (dict, list)):
+                value[key] = decode_extended_json(item)
+    elif isinstance(value, list):
+        for index, item in enumerate(value):
+            if isinstance(item, (dict, list)):
+                value[index] = decode_extended_json(item)
+    return value
+
+
+def _loads_change_event(payload, parsed=None):
+    """
+    Parse a raw (bytes) change event payload, reusing `parsed` if the caller already ran orjson on it.
+    Extended-JSON types are decoded on the parsed tree; bson.json_util is only the
+    fallback for wrappers decode_extended_json does not handle.
+    """
+    if parsed is None:
+        parsed = orjson.loads(payload)
+    if EXTENDED_JSON_MARKER not in payload:
+        return parsed
+    try:
+        return decode_extended_json(parsed)
+    except UnsupportedExtendedJson:
+        return json_util.loads(payload.decode('utf-8'))
+
+
+def _log_envelope_structure(envelope):
+    """Debug-only description of a Pub/Sub push envelope"""
+    logger.debug("[PUBSUB_ENVELOPE] Envelope type: %s", type(envelope))
+    if not isinstance(envelope, dict):
+        return
+    logger.debug("[PUBSUB_ENVELOPE] Envelope keys: %s", list(envelope.keys()))
+    
+    message = envelope.get('message')
+    if not isinstance(message, dict):
+        return
+    logger.debug("[PUBSUB_ENVELOPE] message keys: %s", list(message.keys()))
+    if 'attributes' in message:
+        logger.debug("[PUBSUB_ENVELOPE] message.attributes: %s", message['attributes'])
+    if 'data' in message:
+        data_str = message['data']
+        logger.debug("[PUBSUB_ENVELOPE] message.data length: %d chars", len(data_str))
+        logger.debug("[PUBSUB_ENVELOPE] message.data preview (first 100 chars): %s...", data_str[:100])
 
 
 @app.route("/", methods=["POST"])
@@ -538,109 +992,85 @@ def handle_pubsub():
     try:
         envelope = request.get_json()
         
-        # ==================== PUBSUB ENVELOPE LOGGING ====================
-        print(f"[PUBSUB_ENVELOPE] ============ BEGIN PUBSUB ANALYSIS ============")
-        print(f"[PUBSUB_ENVELOPE] Envelope type: {type(envelope)}")
-        if isinstance(envelope, dict):
-            print(f"[PUBSUB_ENVELOPE] Envelope keys: {list(envelope.keys())}")
-            if 'message' in envelope:
-                message = envelope['message']
-                print(f"[PUBSUB_ENVELOPE] message keys: {list(message.keys()) if isinstance(message, dict) else 'Not a dict'}")
-                if isinstance(message, dict) and 'attributes' in message:
-                    print(f"[PUBSUB_ENVELOPE] message.attributes: {message['attributes']}")
-                if isinstance(message, dict) and 'data' in message:
-                    # Check data length before decoding
-                    data_str = message['data']
-                    print(f"[PUBSUB_ENVELOPE] message.data length: {len(data_str)} chars")
-                    print(f"[PUBSUB_ENVELOPE] message.data preview (first 100 chars): {data_str[:100]}...")
-        print(f"[PUBSUB_ENVELOPE] ============ END PUBSUB ANALYSIS ============")
-        # ==================== END PUBSUB ENVELOPE LOGGING ====================
+        if logger.isEnabledFor(logging.DEBUG):
+            _log_envelope_structure(envelope)
         
         if not envelope or 'message' not in envelope:
-            print("[PUBSUB_HANDLER] Bad Request: invalid Pub/Sub message format")
+            logger.warning("[PUBSUB_HANDLER] Bad Request: invalid Pub/Sub message format")
             return "Bad Request: invalid Pub/Sub message format", 400
 
         message = envelope['message']
         if 'data' not in message:
-            print("[PUBSUB_HANDLER] Bad Request: no data in Pub/Sub message")
+            logger.warning("[PUBSUB_HANDLER] Bad Request: no data in Pub/Sub message")
             return "Bad Request: no data in Pub/Sub message", 400
 
-        print("[PUBSUB_HANDLER] Processing Pub/Sub message...")
+        # The ingestor publishes the collection as a message attribute, so unsupported
+        # collections can be skipped before the payload is decoded at all. 'unknown' is
+        # the ingestor's placeholder; those messages still go through collection inference
+        attribute_collection = (message.get('attributes') or {}).get('collection')
+        if (attribute_collection and attribute_collection != 'unknown'
+                and attribute_collection not in SUPPORTED_COLLECTIONS):
+            logger.info("[PUBSUB_HANDLER] Skipping unsupported collection: %s (see /debug for available collections)",
+                        attribute_collection)
+            return f"Skipped: skipped_{attribute_collection}", 200
+
+        logger.debug("[PUBSUB_HANDLER] Processing Pub/Sub message...")
 
         # Decode the outer message data. This is the payload from the Pub/Sub topic.
-        message_data_str = base64.b64decode(message['data']).decode('utf-8')
-        print(f"[PUBSUB_HANDLER] Decoded outer message length: {len(message_data_str)}")
+        # Kept as bytes: orjson parses bytes directly, so no UTF-8 decode/copy is needed.
+        # a2b_base64 reads the ASCII str in place, where b64decode would first copy it to bytes.
+        message_data = binascii.a2b_base64(message['data'])
+        logger.debug("[PUBSUB_HANDLER] Decoded outer message length: %d", len(message_data))
 
-        # ==================== DECODED MESSAGE LOGGING ====================
-        print(f"[DECODED_MESSAGE] ============ BEGIN DECODED ANALYSIS ============")
-        print(f"[DECODED_MESSAGE] Decoded string preview (first 200 chars): {message_data_str[:200]}...")
+        # Parse once: the same result is used for nested-payload detection and, for direct
+        # payloads, as the final data.
+        outer_payload = orjson.loads(message_data)
         
-        # Try to parse as JSON to see structure
-        try:
-            decoded_json = json.loads(message_data_str)
-            print(f"[DECODED_MESSAGE] Successfully parsed as JSON")
-            print(f"[DECODED_MESSAGE] JSON type: {type(decoded_json)}")
-            if isinstance(decoded_json, dict):
-                print(f"[DECODED_MESSAGE] JSON keys: {list(decoded_json.keys())}")
-                if 'message' in decoded_json:
-                    print(f"[DECODED_MESSAGE] Has nested 'message' key - likely CloudEvents wrapper")
-                    if isinstance(decoded_json['message'], dict) and 'data' in decoded_json['message']:
-                        print(f"[DECODED_MESSAGE] Nested message.data exists - double encoding detected")
-        except json.JSONDecodeError as e:
-            print(f"[DECODED_MESSAGE] Not valid JSON: {e}")
-        
-        print(f"[DECODED_MESSAGE] ============ END DECODED ANALYSIS ============")
-        # ==================== END DECODED MESSAGE LOGGING ====================
-
-        final_payload_str = message_data_str
         # The ingestor service might wrap its payload inside another message (double-encoding).
-        try:
-            outer_payload = json.loads(message_data_str)
-            if isinstance(outer_payload, dict) and 'message' in outer_payload and 'data' in outer_payload['message']:
-                # This is a nested payload. The real data is one level deeper.
-                print("[PUBSUB_HANDLER] Detected nested payload, extracting inner data...")
-                final_payload_str = base64.b64decode(outer_payload['message']['data']).decode('utf-8')
-                print(f"[PUBSUB_HANDLER] Extracted inner payload length: {len(final_payload_str)}")
-        except json.JSONDecodeError:
-            # If it's not a JSON string, it's likely the direct, non-nested payload.
-            print("[PUBSUB_HANDLER] Using direct payload (not nested)")
-            pass
-
-        # Parse the final data string, which might contain BSON types like ObjectId.
-        final_data = json_util.loads(final_payload_str)
-        print(f"[PUBSUB_HANDLER] Parsed final data type: {type(final_data)}")
+        if (isinstance(outer_payload, dict) and isinstance(outer_payload.get('message'), dict)
+                and 'data' in outer_payload['message']):
+            # This is a nested payload. The real data is one level deeper.
+            logger.debug("[PUBSUB_HANDLER] Detected nested payload, extracting inner data...")
+            final_payload = binascii.a2b_base64(outer_payload['message']['data'])
+            logger.debug("[PUBSUB_HANDLER] Extracted inner payload length: %d", len(final_payload))
+            final_data = _loads_change_event(final_payload)
+        else:
+            # Direct payload: reuse the parse above
+            final_data = _loads_change_event(message_data, parsed=outer_payload)
+        
+        logger.debug("[PUBSUB_HANDLER] Parsed final data type: %s", type(final_data))
         if isinstance(final_data, dict) and 'collection' in final_data:
-            print(f"[PUBSUB_HANDLER] Processing collection: {final_data.get('collection')}, operation: {final_data.get('operation', 'unknown')}")
+            logger.debug("[PUBSUB_HANDLER] Processing collection: %s, operation: %s",
+                         final_data.get('collection'), final_data.get('operation', 'unknown'))
 
         # Process to parquet
         output_path = process_pubsub_message_to_parquet(final_data)
 
-        if output_path and not output_path.startswith('skipped_'):
-            print(f"[PUBSUB_HANDLER] SUCCESS: Processed message to {output_path}")
-            return f"Processed: {output_path}", 200
+        if output_path and output_path.startswith('buffered_'):
+            return f"Buffered: {output_path}", 200
+        elif output_path and output_path.startswith('queued_'):
+            return f"Queued: {output_path}", 200
         elif output_path and output_path.startswith('skipped_'):
-            print(f"[PUBSUB_HANDLER] SKIPPED: {output_path}")
             return f"Skipped: {output_path}", 200
+        elif output_path:
+            logger.info("[PUBSUB_HANDLER] SUCCESS: Processed message to %s", output_path)
+            return f"Processed: {output_path}", 200
         else:
-            print("[PUBSUB_HANDLER] WARNING: Message processed, but no output generated")
+            logger.warning("[PUBSUB_HANDLER] Message processed, but no output generated")
             return "Message processed, but no output generated.", 200
 
     except (json.JSONDecodeError, UnicodeDecodeError) as e:
-        error_msg = f"Error decoding or parsing Pub/Sub message: {e}"
-        print(f"[PUBSUB_HANDLER] ERROR: {error_msg}")
+        logger.error("[PUBSUB_HANDLER] ERROR: Error decoding or parsing Pub/Sub message: %s", e)
         return f"Bad Request: could not decode message data. Error: {e}", 400
     except Exception as e:
-        error_msg = f"Error handling Pub/Sub message: {e}"
-        print(f"[PUBSUB_HANDLER] CRITICAL ERROR: {error_msg}")
-        import traceback
-        print(f"[PUBSUB_HANDLER] Traceback: {traceback.format_exc()}")
+        logger.exception("[PUBSUB_HANDLER] CRITICAL ERROR: Error handling Pub/Sub message: %s", e)
         return f"Internal Server Error: {str(e)}", 500
 
 
 @app.route("/health")
 def health_check():
     """Health check endpoint"""
-    available_collections = get_available_collections()
+    available_collections = list(AVAILABLE_COLLECTIONS)
     monitor_status = "enabled" if (schema_monitor and getattr(schema_monitor, 'enabled', False)) else "disabled"
     
     return {
@@ -650,14 +1080,15 @@ def health_check():
         "project_id": PROJECT_ID,
         "gcs_bucket": GCS_PROCESSED_BUCKET_NAME,
         "schema_monitoring": monitor_status,
-        "resilience_mode": "enabled"
+        "resilience_mode": "enabled",
+        "pending_batches": document_batcher.pending_counts()
     }, 200
 
 
 @app.route("/debug")
 def debug_info():
     """Debug endpoint to check configuration"""
-    available_collections = get_available_collections()
+    available_collections = list(AVAILABLE_COLLECTIONS)
     schemas_info = {}
     
     for collection in available_collections:
@@ -686,10 +1117,11 @@ def debug_info():
     }
 
 
+# Local development only - in Cloud Run the app is served by gunicorn (see Dockerfile)
 if __name__ == "__main__":
-    print("[STARTUP] Starting Cloud Run Transformer Service...")
-    print(f"[STARTUP] Available collections: {get_available_collections()}")
-    print(f"[STARTUP] PROJECT_ID: {PROJECT_ID}")
-    print(f"[STARTUP] GCS_PROCESSED_BUCKET_NAME: {GCS_PROCESSED_BUCKET_NAME}")
-    print("[STARTUP] Resilience mode: ENABLED - Will continue processing despite schema drift")
-    app.run(debug=True, host='0.0.0.0', port=int(os.environ.get('PORT', 8080)))
\ No newline at end of file
+    logger.info("[STARTUP] Starting Cloud Run Transformer Service...")
+    logger.info("[STARTUP] Available collections: %s", list(AVAILABLE_COLLECTIONS))
+    logger.info("[STARTUP] PROJECT_ID: %s", PROJECT_ID)
+    logger.info("[STARTUP] GCS_PROCESSED_BUCKET_NAME: %s", GCS_PROCESSED_BUCKET_NAME)
+    logger.info("[STARTUP] Resilience mode: ENABLED - Will continue processing despite schema drift")
+    app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 8080)))
\ No newline at end of file
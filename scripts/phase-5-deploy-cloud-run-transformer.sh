@@ -110,13 +110,14 @@ gcloud run deploy "$CLOUD_RUN_TRANSFORMER_NAME" \
   --region="$REGION" \
   --project="$PROJECT_ID" \
   --service-account="$CLOUD_RUN_SA" \
-  --set-env-vars="PROJECT_ID=$PROJECT_ID,GCS_PROCESSED_BUCKET_NAME=$GCS_PROCESSED_BUCKET_NAME,BUILD_TAG=$UNIQUE_TAG" \
+  --set-env-vars="PROJECT_ID=$PROJECT_ID,GCS_PROCESSED_BUCKET_NAME=$GCS_PROCESSED_BUCKET_NAME,BUILD_TAG=$UNIQUE_TAG,BATCH_MAX_ROWS=${BATCH_MAX_ROWS:-8192},BATCH_MAX_AGE_SECONDS=${BATCH_MAX_AGE_SECONDS:-30},LOG_LEVEL=${LOG_LEVEL:-INFO}" \
   --memory=2Gi \
   --cpu=2 \
   --timeout=3600 \
   --concurrency=1000 \
-  --min-instances=0 \
+  --min-instances=1 \
   --max-instances=10 \
+  --no-cpu-throttling \
   --execution-environment=gen2 \
   --cpu-boost \
   --port=8080 \